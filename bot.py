@@ -462,8 +462,7 @@ async def _save_referrals() -> None:
     try:
         import db as _db
         if _db.is_enabled():
-            for uid, data in REFERRALS.items():
-                await _db.ref_save(uid, data)
+            await _db.ref_save_many(REFERRALS)
             return
     except Exception as e:
         logger.warning(f"Ошибка сохранения рефералов в БД: {e}")
@@ -513,6 +512,11 @@ async def _apply_referral_earnings_for_purchase(
     if not uid:
         logger.warning("apply_referral_earnings: пустой user_id, начисление пропущено")
         return
+    import db as _db
+    if not _db.is_user_id(uid):
+        # "unknown" из заказа без user_id: такую запись REFERRALS нельзя сохранить в PostgreSQL
+        logger.warning("apply_referral_earnings: не-числовой user_id=%r, начисление пропущено", uid)
+        return
 
     # Загружаем существующие данные (из БД или JSON) и обновляем по цепочке
     await _load_referrals()
@@ -2534,15 +2538,16 @@ def setup_http_server():
             user_id = await _db_admin.user_find_by_username(username)
             if not user_id:
                 return _json_response({"success": False, "error": "not_found", "message": "Пользователь не найден"}, status=404)
+        elif not _db_admin.is_user_id(user_id):
+            return _json_response({"success": False, "error": "bad_request", "message": "user_id должен быть числом"}, status=400)
 
         # Корректируем баланс
         new_balance = None
         if amount > 0:
-            ok = await _db_admin.balance_add_rub(user_id, amount)
-            if not ok:
+            res = await _db_admin.balance_apply_delta(user_id, rub_delta=amount)
+            if res is None:
                 return _json_response({"success": False, "error": "db_error", "message": "Не удалось пополнить баланс"}, status=500)
-            bal = await _db_admin.balance_get(user_id)
-            new_balance = bal.get("balance_rub", 0.0)
+            new_balance = res.get("balance_rub", 0.0)
         else:
             res = await _db_admin.balance_deduct_rub(user_id, -amount)
             if res is None:
@@ -4013,9 +4018,12 @@ def setup_http_server():
                                 try:
                                     import db as _db
                                     order_id_custom = str(purchase_meta.get("order_id") or "").strip() or None
-                                    if _db.is_enabled():
-                                        await _db.user_upsert(user_id, purchase_meta.get("username") or "", purchase_meta.get("first_name") or "")
-                                        await _db.purchase_add(user_id, amount_rub, stars_amount, "stars", f"{stars_amount} звёзд", order_id_custom)
+                                    if _db.is_enabled() and not _db.is_user_id(user_id):
+                                        logger.warning("Platega payment_check: в заказе нет числового user_id (%r), покупка не записана в БД", user_id)
+                                    elif _db.is_enabled():
+                                        async with _db.transaction() as conn:
+                                            await _db.user_upsert(user_id, purchase_meta.get("username") or "", purchase_meta.get("first_name") or "", conn=conn)
+                                            await _db.purchase_add(user_id, amount_rub, stars_amount, "stars", f"{stars_amount} звёзд", order_id_custom, conn=conn)
                                     await _apply_referral_earnings_for_purchase(
                                         user_id=user_id,
                                         amount_rub=amount_rub,
@@ -4302,20 +4310,25 @@ def setup_http_server():
                                                             product_name = f"{stars_amount} звёзд"
                                                             order_id_custom = str(purchase_meta.get("order_id") or "").strip() or None
                                                             import db as _db
-                                                            if _db.is_enabled():
-                                                                await _db.user_upsert(
-                                                                    user_id,
-                                                                    purchase_meta.get("username") or "",
-                                                                    purchase_meta.get("first_name") or "",
-                                                                )
-                                                                await _db.purchase_add(
-                                                                    user_id,
-                                                                    amount_rub,
-                                                                    stars_amount,
-                                                                    purchase_type_str,
-                                                                    product_name,
-                                                                    order_id_custom,
-                                                                )
+                                                            if _db.is_enabled() and not _db.is_user_id(user_id):
+                                                                logger.warning("CryptoBot payment_check: в заказе нет числового user_id (%r), покупка не записана в БД", user_id)
+                                                            elif _db.is_enabled():
+                                                                async with _db.transaction() as conn:
+                                                                    await _db.user_upsert(
+                                                                        user_id,
+                                                                        purchase_meta.get("username") or "",
+                                                                        purchase_meta.get("first_name") or "",
+                                                                        conn=conn,
+                                                                    )
+                                                                    await _db.purchase_add(
+                                                                        user_id,
+                                                                        amount_rub,
+                                                                        stars_amount,
+                                                                        purchase_type_str,
+                                                                        product_name,
+                                                                        order_id_custom,
+                                                                        conn=conn,
+                                                                    )
                                                             else:
                                                                 # Fallback на JSON файл
                                                                 path = _get_users_data_path()
@@ -4980,9 +4993,12 @@ def setup_http_server():
                                         product_name = purchase.get("productName") or purchase.get("product_name") or f"{stars_amount} звёзд"
                                         order_id_custom = str(purchase.get("order_id") or "").strip() or None
                                         
-                                        if _db.is_enabled():
-                                            await _db.user_upsert(user_id, purchase.get("username") or "", purchase.get("first_name") or "")
-                                            await _db.purchase_add(user_id, amount_rub, stars_amount, purchase_type_str, product_name, order_id_custom)
+                                        if _db.is_enabled() and not _db.is_user_id(user_id):
+                                            logger.warning("CryptoBot webhook: в заказе нет числового user_id (%r), покупка не записана в БД", user_id)
+                                        elif _db.is_enabled():
+                                            async with _db.transaction() as conn:
+                                                await _db.user_upsert(user_id, purchase.get("username") or "", purchase.get("first_name") or "", conn=conn)
+                                                await _db.purchase_add(user_id, amount_rub, stars_amount, purchase_type_str, product_name, order_id_custom, conn=conn)
                                         else:
                                             # Fallback на JSON файл
                                             path = _get_users_data_path()
@@ -5212,18 +5228,24 @@ def setup_http_server():
                     )
             elif context == "deposit":
                 import db as _db_dep
-                if _db_dep.is_enabled() and amount_rub > 0:
-                    await _db_dep.balance_add_rub(user_id, amount_rub)
-                    await _db_dep.user_upsert(
-                        user_id,
-                        (order_meta.get("purchase") or {}).get("username") or "",
-                        (order_meta.get("purchase") or {}).get("first_name") or "",
-                    )
-                    await _db_dep.purchase_add(
-                        user_id, amount_rub, 0, "balance",
-                        f"Пополнение баланса на {amount_rub:.0f} ₽",
-                        None,
-                    )
+                if _db_dep.is_enabled() and not _db_dep.is_user_id(user_id):
+                    logger.warning("CryptoBot webhook: в заказе нет числового user_id (%r), пополнение не зачислено", user_id)
+                elif _db_dep.is_enabled() and amount_rub > 0:
+                    # Зачисление и запись о пополнении — одной транзакцией: либо обе, либо ни одной
+                    async with _db_dep.transaction() as conn:
+                        await _db_dep.balance_add_rub(user_id, amount_rub, conn=conn)
+                        await _db_dep.user_upsert(
+                            user_id,
+                            (order_meta.get("purchase") or {}).get("username") or "",
+                            (order_meta.get("purchase") or {}).get("first_name") or "",
+                            conn=conn,
+                        )
+                        await _db_dep.purchase_add(
+                            user_id, amount_rub, 0, "balance",
+                            f"Пополнение баланса на {amount_rub:.0f} ₽",
+                            None,
+                            conn=conn,
+                        )
                 order_meta["delivered"] = True
                 if isinstance(orders, dict):
                     orders[str(invoice_id)] = order_meta
@@ -5473,9 +5495,12 @@ def setup_http_server():
                         _save_platega_order_to_file(str(tid), order_meta)
                         import db as _db
                         order_id_custom = str(purchase.get("order_id") or "").strip() or None
-                        if _db.is_enabled():
-                            await _db.user_upsert(user_id, purchase.get("username") or "", purchase.get("first_name") or "")
-                            await _db.purchase_add(user_id, amount_rub, stars_amount, "stars", f"{stars_amount} звёзд", order_id_custom)
+                        if _db.is_enabled() and not _db.is_user_id(user_id):
+                            logger.warning("Platega callback: в заказе нет числового user_id (%r), покупка не записана в БД", user_id)
+                        elif _db.is_enabled():
+                            async with _db.transaction() as conn:
+                                await _db.user_upsert(user_id, purchase.get("username") or "", purchase.get("first_name") or "", conn=conn)
+                                await _db.purchase_add(user_id, amount_rub, stars_amount, "stars", f"{stars_amount} звёзд", order_id_custom, conn=conn)
                         await _apply_referral_earnings_for_purchase(
                             user_id=user_id, amount_rub=amount_rub,
                             username=purchase.get("username") or "", first_name=purchase.get("first_name") or "",
@@ -5967,9 +5992,12 @@ def setup_http_server():
 
                         # Используем original_order_id из order_meta (с #), если есть, иначе из purchase
                         order_id_custom = str(order_meta.get("original_order_id") or purchase.get("order_id") or "").strip() or None
-                        if _db.is_enabled():
-                            await _db.user_upsert(user_id, purchase.get("username") or "", purchase.get("first_name") or "")
-                            await _db.purchase_add(user_id, amount_rub, stars_amount, "stars", f"{stars_amount} звёзд", order_id_custom)
+                        if _db.is_enabled() and not _db.is_user_id(user_id):
+                            logger.warning("FreeKassa notify: в заказе нет числового user_id (%r), покупка не записана в БД", user_id)
+                        elif _db.is_enabled():
+                            async with _db.transaction() as conn:
+                                await _db.user_upsert(user_id, purchase.get("username") or "", purchase.get("first_name") or "", conn=conn)
+                                await _db.purchase_add(user_id, amount_rub, stars_amount, "stars", f"{stars_amount} звёзд", order_id_custom, conn=conn)
                         logger.info("FreeKassa notify: purchase_add called for user_id=%s, order_id=%s, stars=%s", user_id, order_id_custom, stars_amount)
                         await _apply_referral_earnings_for_purchase(
                             user_id=user_id,
@@ -6011,6 +6039,26 @@ def setup_http_server():
                 )
                 logger.info("FreeKassa notify: spin delivered, MERCHANT_ORDER_ID=%s", merchant_order_id)
             elif ptype == "balance":
+                import db as _db_bal
+                if _db_bal.is_enabled() and not _db_bal.is_user_id(user_id):
+                    logger.warning("FreeKassa notify: в заказе нет числового user_id (%r), пополнение не зачислено", user_id)
+                elif _db_bal.is_enabled() and amount_rub > 0:
+                    # Зачисление и запись о пополнении — одной транзакцией: либо обе, либо ни одной
+                    async with _db_bal.transaction() as conn:
+                        await _db_bal.balance_add_rub(user_id, amount_rub, conn=conn)
+                        await _db_bal.user_upsert(
+                            user_id,
+                            purchase.get("username") or "",
+                            purchase.get("first_name") or "",
+                            conn=conn,
+                        )
+                        await _db_bal.purchase_add(
+                            user_id, amount_rub, 0, "balance",
+                            f"Пополнение баланса на {amount_rub:.0f} ₽",
+                            purchase.get("order_id"),
+                            conn=conn,
+                        )
+                # delivered — только после COMMIT: иначе при откате зачисления повторное уведомление сочтут выполненным
                 order_meta["delivered"] = True
                 try:
                     orders_fk = request.app.get("freekassa_orders")
@@ -6019,19 +6067,6 @@ def setup_http_server():
                 except Exception:
                     pass
                 _save_freekassa_order_to_file(str(merchant_order_id), order_meta)
-                import db as _db_bal
-                if _db_bal.is_enabled() and amount_rub > 0:
-                    await _db_bal.balance_add_rub(user_id, amount_rub)
-                    await _db_bal.user_upsert(
-                        user_id,
-                        purchase.get("username") or "",
-                        purchase.get("first_name") or "",
-                    )
-                    await _db_bal.purchase_add(
-                        user_id, amount_rub, 0, "balance",
-                        f"Пополнение баланса на {amount_rub:.0f} ₽",
-                        purchase.get("order_id"),
-                    )
                 logger.info("FreeKassa notify: balance deposit delivered, MERCHANT_ORDER_ID=%s, amount_rub=%s", merchant_order_id, amount_rub)
             elif ptype == "steam":
                 account = (purchase.get("login") or "").strip()
@@ -6230,6 +6265,8 @@ def setup_http_server():
             if not uid:
                 return _json_response({"error": "userId required"}, status=400)
             import db as _db
+            if _db.is_enabled() and not _db.is_user_id(uid):
+                return _json_response({"error": "userId must be numeric"}, status=400)
             if _db.is_enabled():
                 await _db.rating_set(uid, bool(show))
             else:
@@ -6376,10 +6413,11 @@ def setup_http_server():
         if not _db_bal.is_enabled():
             return _json_response({"error": "service_unavailable", "message": "Баланс временно недоступен"}, status=503)
         if currency == "RUB":
-            await _db_bal.balance_add_rub(user_id, amount)
+            new_bal = await _db_bal.balance_apply_delta(user_id, rub_delta=amount)
         else:
-            await _db_bal.balance_add_usdt(user_id, amount)
-        new_bal = await _db_bal.balance_get(user_id)
+            new_bal = await _db_bal.balance_apply_delta(user_id, usdt_delta=amount)
+        if new_bal is None:
+            new_bal = await _db_bal.balance_get(user_id)
         return _json_response({
             "success": True,
             "balance_rub": new_bal["balance_rub"],
@@ -6459,9 +6497,9 @@ def setup_http_server():
                 {"success": False, "error": "insufficient_funds", "message": "Недостаточно средств на балансе"},
                 status=400,
             )
+        final_bal = new_bal
         if win_amount > 0:
-            await _db_ruo.balance_add_rub(user_id, win_amount)
-        final_bal = await _db_ruo.balance_get(user_id)
+            final_bal = await _db_ruo.balance_apply_delta(user_id, rub_delta=win_amount) or new_bal
 
         # При желании здесь можно дописать запись транзакции в отдельную таблицу.
         return _json_response({
@@ -6510,6 +6548,9 @@ def setup_http_server():
             referral_only = bool(body.get("referral_only"))
             if not user_id:
                 return _json_response({"error": "user_id required"}, status=400)
+            import db as _db
+            if _db.is_enabled() and not _db.is_user_id(user_id):
+                return _json_response({"error": "user_id must be numeric"}, status=400)
             if amount_rub <= 0:
                 return _json_response({"error": "amount_rub must be > 0"}, status=400)
             
@@ -6517,9 +6558,10 @@ def setup_http_server():
             if not referral_only and purchase_type == "stars":
                 import db as _db
                 if _db.is_enabled():
-                    await _db.user_upsert(user_id, username, first_name)
-                    # Для старого/ручного эндпоинта order_id не передаём (None)
-                    await _db.purchase_add(user_id, amount_rub, stars_amount, purchase_type, product_name, None)
+                    async with _db.transaction() as conn:
+                        await _db.user_upsert(user_id, username, first_name, conn=conn)
+                        # Для старого/ручного эндпоинта order_id не передаём (None)
+                        await _db.purchase_add(user_id, amount_rub, stars_amount, purchase_type, product_name, None, conn=conn)
                 else:
                     path = _get_users_data_path()
                     users_data = _read_json_file(path) or {}
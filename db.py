@@ -3,14 +3,26 @@
 import os
 import json
 import logging
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
-from typing import Optional
+from typing import AsyncIterator, Iterable, Optional
 
 logger = logging.getLogger(__name__)
 
 _pool = None
 _db_enabled = False
 
+# Отдельное соединение под LISTEN: соединения пула не годятся — при возврате в пул asyncpg делает UNLISTEN *
+_listen_conn = None
+
+# Кэш курсов (app_rates): меняются редко, а читаются почти на каждое сообщение
+_rates_cache: dict | None = None
+_rates_cache_ts: float = 0.0
+# Растёт при каждом сбросе кэша: выборка, начатая до сброса, не должна записать старые курсы как свежие
+_rates_cache_gen = 0
+_RATES_TTL = 30.0
+
 
 async def init_pool() -> bool:
     """Инициализация пула подключений. Возвращает True если PostgreSQL доступен."""
@@ -21,9 +33,11 @@ async def init_pool() -> bool:
         return False
     try:
         import asyncpg
-        _pool = await asyncpg.create_pool(url, min_size=1, max_size=10, command_timeout=60)
+        _pool = await asyncpg.create_pool(url, min_size=1, max_size=10, command_timeout=60, init=_init_conn)
         await _ensure_schema()
+        await _start_listener(url)
         _db_enabled = True
+        globals().update(_REAL_BACKEND)
         logger.info("PostgreSQL подключён")
         return True
     except ImportError:
@@ -34,10 +48,49 @@ async def init_pool() -> bool:
         return False
 
 
+def _json_encode(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+async def _init_conn(conn):
+    """Настройка каждого нового соединения пула: json/jsonb <-> Python-объекты без ручных dumps/loads."""
+    for typename in ("json", "jsonb"):
+        await conn.set_type_codec(
+            typename, encoder=_json_encode, decoder=json.loads, schema="pg_catalog"
+        )
+
+
+async def _start_listener(url: str):
+    """
+    LISTEN rates_changed: rates_set() в любом процессе шлёт NOTIFY,
+    и кэш курсов остальных воркеров сбрасывается сразу, а не по истечении TTL.
+    Без LISTEN бот работает как раньше — кэш курсов живёт _RATES_TTL секунд.
+    """
+    global _listen_conn
+    import asyncpg
+    try:
+        _listen_conn = await asyncpg.connect(url)
+        await _listen_conn.add_listener("rates_changed", _on_rates_changed)
+    except Exception as e:
+        logger.warning("PostgreSQL LISTEN недоступен, кэш курсов сбрасывается только по TTL: %s", e)
+        if _listen_conn is not None:
+            await _listen_conn.close()
+        _listen_conn = None
+
+
+def _on_rates_changed(conn, pid, channel, payload):
+    _rates_cache_invalidate()
+
+
 async def close_pool():
     """Закрытие пула."""
-    global _pool, _db_enabled
+    global _pool, _db_enabled, _listen_conn
     _db_enabled = False
+    globals().update(_DISABLED_BACKEND)
+    _rates_cache_invalidate()
+    if _listen_conn is not None:
+        await _listen_conn.close()
+        _listen_conn = None
     if _pool:
         await _pool.close()
         _pool = None
@@ -48,279 +101,586 @@ def is_enabled() -> bool:
     return _db_enabled
 
 
+@asynccontextmanager
+async def transaction():
+    """
+    Одно соединение и одна транзакция на всю бизнес-операцию вебхука:
+
+        async with db.transaction() as conn:
+            await db.balance_add_rub(user_id, amount, conn=conn)
+            await db.purchase_add(..., conn=conn)
+
+    Функции с параметром conn выполняются на нём вместо отдельного acquire() из пула.
+    """
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            yield conn
+
+
+@asynccontextmanager
+async def _acquire(conn=None):
+    """Соединение вызывающего (conn из transaction()) или новое из пула."""
+    if conn is not None:
+        yield conn
+    else:
+        async with _pool.acquire() as c:
+            yield c
+
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    id BIGINT PRIMARY KEY,
+    username TEXT DEFAULT '',
+    first_name TEXT DEFAULT '',
+    last_name TEXT DEFAULT '',
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS purchases (
+    id SERIAL PRIMARY KEY,
+    user_id BIGINT NOT NULL,
+    amount_rub NUMERIC(12,2) NOT NULL,
+    stars_amount INTEGER DEFAULT 0,
+    type TEXT DEFAULT 'stars',
+    product_name TEXT DEFAULT '',
+    order_id TEXT,
+    created_at TIMESTAMPTZ DEFAULT NOW()
+);
+-- Миграция: добавить order_id, если таблица создана без неё (старые инсталлы)
+ALTER TABLE purchases ADD COLUMN IF NOT EXISTS order_id TEXT;
+-- Звёзды с фолбэком "сумма / 0.65", если stars_amount не передан (0). Считается один раз при записи.
+ALTER TABLE purchases ADD COLUMN IF NOT EXISTS stars_amount_eff INTEGER
+    GENERATED ALWAYS AS (COALESCE(NULLIF(stars_amount, 0), TRUNC(amount_rub / 0.65)::int)) STORED;
+-- (user_id, created_at DESC) покрывает и поиск по user_id, и агрегацию в get_users_with_purchases
+CREATE INDEX IF NOT EXISTS idx_purchases_user_created ON purchases(user_id, created_at DESC);
+DROP INDEX IF EXISTS idx_purchases_user;
+CREATE INDEX IF NOT EXISTS idx_purchases_created ON purchases(created_at);
+CREATE TABLE IF NOT EXISTS referrals (
+    user_id BIGINT PRIMARY KEY,
+    parent1 BIGINT,
+    parent2 BIGINT,
+    parent3 BIGINT,
+    earned_rub NUMERIC(12,2) DEFAULT 0,
+    volume_rub NUMERIC(12,2) DEFAULT 0,
+    username TEXT DEFAULT '',
+    first_name TEXT DEFAULT '',
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+-- Рёбра реферального дерева: источник правды для списков L1/L2/L3.
+-- Добавление реферала — O(log n) INSERT вместо перезаписи JSONB-массива.
+CREATE TABLE IF NOT EXISTS referrals_edges (
+    parent_id BIGINT NOT NULL,
+    child_id BIGINT NOT NULL,
+    level SMALLINT NOT NULL CHECK (level BETWEEN 1 AND 3),
+    PRIMARY KEY (parent_id, level, child_id)
+);
+CREATE INDEX IF NOT EXISTS idx_ref_edges_child ON referrals_edges(child_id, level);
+CREATE TABLE IF NOT EXISTS rating_prefs (
+    user_id BIGINT PRIMARY KEY,
+    show_in_rating BOOLEAN DEFAULT TRUE,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE TABLE IF NOT EXISTS app_rates (
+    key TEXT PRIMARY KEY,
+    value NUMERIC(12,4) NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+-- Балансы пользователей (источник правды; изменения только на сервере)
+CREATE TABLE IF NOT EXISTS user_balances (
+    user_id BIGINT PRIMARY KEY,
+    balance_rub NUMERIC(12,2) NOT NULL DEFAULT 0 CHECK (balance_rub >= 0),
+    balance_usdt NUMERIC(12,6) NOT NULL DEFAULT 0 CHECK (balance_usdt >= 0),
+    updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+-- View пересоздаётся ниже; убираем его заранее, иначе ALTER COLUMN TYPE по его колонкам невозможен
+DROP VIEW IF EXISTS referrals_full;
+-- Строки, которые миграция в BIGINT не смогла перенести (не-числовой ID, например 'unknown' из вебхуков)
+CREATE TABLE IF NOT EXISTS legacy_nonnumeric_ids (
+    table_name TEXT NOT NULL,
+    column_name TEXT NOT NULL,
+    row_data JSONB NOT NULL,
+    moved_at TIMESTAMPTZ DEFAULT NOW()
+);
+-- Миграция: Telegram user_id из TEXT в BIGINT (старые инсталлы). Индексы меньше, сравнение — целых чисел.
+-- Не-числовые значения копируются в legacy_nonnumeric_ids; из NOT NULL-колонок такие строки удаляются,
+-- в остальных (parent1..3) ID становится NULL. Иначе один 'unknown' валит всю схему при старте.
+DO $$
+DECLARE
+    col RECORD;
+    bad TEXT;
+BEGIN
+    FOR col IN
+        SELECT table_name, column_name, is_nullable FROM information_schema.columns
+        WHERE table_schema = current_schema()
+          AND data_type = 'text'
+          AND (table_name, column_name) IN (
+              ('users', 'id'), ('purchases', 'user_id'),
+              ('referrals', 'user_id'), ('referrals', 'parent1'), ('referrals', 'parent2'), ('referrals', 'parent3'),
+              ('referrals_edges', 'parent_id'), ('referrals_edges', 'child_id'),
+              ('rating_prefs', 'user_id'), ('user_balances', 'user_id')
+          )
+    LOOP
+        bad := format('%I !~ ''^[0-9]{1,18}$''', col.column_name);
+        IF col.is_nullable = 'YES' THEN
+            -- Пустая строка в nullable-колонке — просто «нет родителя», в карантин её не кладём
+            bad := format('%s AND %I <> ''''', bad, col.column_name);
+        END IF;
+        EXECUTE format(
+            'INSERT INTO legacy_nonnumeric_ids (table_name, column_name, row_data) SELECT %L, %L, to_jsonb(t) FROM %I t WHERE %s',
+            col.table_name, col.column_name, col.table_name, bad
+        );
+        IF col.is_nullable = 'NO' THEN
+            EXECUTE format('DELETE FROM %I WHERE %s', col.table_name, bad);
+        END IF;
+        EXECUTE format(
+            'ALTER TABLE %I ALTER COLUMN %I TYPE BIGINT USING CASE WHEN %I ~ ''^[0-9]{1,18}$'' THEN %I::bigint END',
+            col.table_name, col.column_name, col.column_name, col.column_name
+        );
+    END LOOP;
+END $$;
+-- Миграция: списки referrals_l1/l2/l3 (JSONB) на старых инсталлах переносятся в referrals_edges,
+-- после чего колонки удаляются. Списки отдаёт view referrals_full (BIGINT[], собираются из рёбер).
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'referrals' AND column_name = 'referrals_l1'
+    ) THEN
+        INSERT INTO referrals_edges (parent_id, child_id, level)
+            SELECT r.user_id, c.child_id::bigint, v.level
+            FROM referrals r
+            CROSS JOIN LATERAL (VALUES (1, r.referrals_l1), (2, r.referrals_l2), (3, r.referrals_l3)) AS v(level, arr)
+            CROSS JOIN LATERAL jsonb_array_elements_text(
+                CASE WHEN jsonb_typeof(v.arr) = 'array' THEN v.arr ELSE '[]'::jsonb END
+            ) AS c(child_id)
+            WHERE c.child_id ~ '^[0-9]{1,18}$'
+        ON CONFLICT DO NOTHING;
+        ALTER TABLE referrals
+            DROP COLUMN referrals_l1,
+            DROP COLUMN referrals_l2,
+            DROP COLUMN referrals_l3;
+    END IF;
+END $$;
+-- Обратная совместимость: referrals с собранными из рёбер списками referrals_l1/l2/l3
+CREATE VIEW referrals_full AS
+    SELECT
+        r.user_id, r.parent1, r.parent2, r.parent3,
+        COALESCE(array_agg(e.child_id) FILTER (WHERE e.level = 1), '{}') AS referrals_l1,
+        COALESCE(array_agg(e.child_id) FILTER (WHERE e.level = 2), '{}') AS referrals_l2,
+        COALESCE(array_agg(e.child_id) FILTER (WHERE e.level = 3), '{}') AS referrals_l3,
+        r.earned_rub, r.volume_rub, r.username, r.first_name, r.updated_at
+    FROM referrals r
+    LEFT JOIN referrals_edges e ON e.parent_id = r.user_id
+    GROUP BY r.user_id;
+"""
+
+
 async def _ensure_schema():
-    """Создание таблиц при первом запуске."""
+    """Создание таблиц при первом запуске (одним батчем — один round-trip)."""
     async with _pool.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id TEXT PRIMARY KEY,
-                username TEXT DEFAULT '',
-                first_name TEXT DEFAULT '',
-                last_name TEXT DEFAULT '',
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        """)
-        logger.info("PostgreSQL: ensured table 'users'")
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS purchases (
-                id SERIAL PRIMARY KEY,
-                user_id TEXT NOT NULL,
-                amount_rub NUMERIC(12,2) NOT NULL,
-                stars_amount INTEGER DEFAULT 0,
-                type TEXT DEFAULT 'stars',
-                product_name TEXT DEFAULT '',
-                order_id TEXT,
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        """)
-        logger.info("PostgreSQL: ensured table 'purchases'")
-        # Миграция: добавить order_id, если таблица создана без неё (старые инсталлы)
-        await conn.execute("ALTER TABLE purchases ADD COLUMN IF NOT EXISTS order_id TEXT")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_user ON purchases(user_id)")
-        await conn.execute("CREATE INDEX IF NOT EXISTS idx_purchases_created ON purchases(created_at)")
-        logger.info("PostgreSQL: ensured indexes idx_purchases_user, idx_purchases_created")
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS referrals (
-                user_id TEXT PRIMARY KEY,
-                parent1 TEXT,
-                parent2 TEXT,
-                parent3 TEXT,
-                referrals_l1 JSONB DEFAULT '[]',
-                referrals_l2 JSONB DEFAULT '[]',
-                referrals_l3 JSONB DEFAULT '[]',
-                earned_rub NUMERIC(12,2) DEFAULT 0,
-                volume_rub NUMERIC(12,2) DEFAULT 0,
-                username TEXT DEFAULT '',
-                first_name TEXT DEFAULT '',
-                updated_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        """)
-        logger.info("PostgreSQL: ensured table 'referrals'")
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS rating_prefs (
-                user_id TEXT PRIMARY KEY,
-                show_in_rating BOOLEAN DEFAULT TRUE,
-                updated_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        """)
-        logger.info("PostgreSQL: ensured table 'rating_prefs'")
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS app_rates (
-                key TEXT PRIMARY KEY,
-                value NUMERIC(12,4) NOT NULL,
-                updated_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        """)
-        logger.info("PostgreSQL: ensured table 'app_rates'")
-        # Балансы пользователей (источник правды; изменения только на сервере)
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_balances (
-                user_id TEXT PRIMARY KEY,
-                balance_rub NUMERIC(12,2) NOT NULL DEFAULT 0 CHECK (balance_rub >= 0),
-                balance_usdt NUMERIC(12,6) NOT NULL DEFAULT 0 CHECK (balance_usdt >= 0),
-                updated_at TIMESTAMPTZ DEFAULT NOW()
-            )
-        """)
-        logger.info("PostgreSQL: ensured table 'user_balances'")
-    logger.info("Схема PostgreSQL проверена (users, purchases, referrals, rating_prefs, app_rates, user_balances)")
+        async with conn.transaction():
+            await conn.execute(SCHEMA_SQL)
+    logger.info("Схема PostgreSQL проверена (users, purchases, referrals, referrals_edges, rating_prefs, app_rates, user_balances)")
 
 
-# --- Referrals ---
+def is_user_id(user_id) -> bool:
+    """
+    Годится ли значение как Telegram user_id для БД: целое неотрицательное число (int или строка из цифр).
+    Вебхуки подставляют "unknown", если в заказе нет user_id, — такие значения вызывающий код отсекает сам.
+    """
+    text = str(user_id).strip() if user_id is not None else ""
+    return text.isascii() and text.isdigit() and len(text) <= 18
+
 
-async def ref_get_or_create(user_id: str) -> dict:
-    """Получить или создать запись реферала."""
-    if not _db_enabled:
+def _uid(user_id: int | str | None) -> int | None:
+    """
+    Telegram user_id (int или строка — ключи в боте и JSON строковые) -> параметр BIGINT.
+    None и "" -> NULL. Остальное, что не проходит is_user_id(), — ValueError: проверять на входе.
+    """
+    if user_id is None or user_id == "":
         return None
+    if not is_user_id(user_id):
+        raise ValueError(f"некорректный user_id: {user_id!r}")
+    return int(user_id)
+
+
+# Колонки referrals_full для _row_to_ref. ID отдаются текстом: в боте ключи и списки рефералов строковые.
+_REF_COLUMNS = """
+    user_id::text AS user_id,
+    parent1::text AS parent1, parent2::text AS parent2, parent3::text AS parent3,
+    referrals_l1::text[] AS referrals_l1, referrals_l2::text[] AS referrals_l2, referrals_l3::text[] AS referrals_l3,
+    earned_rub, volume_rub, username, first_name
+"""
+
+
+# --- SQL-запросы модуля ---
+# Все тексты запросов собраны здесь, чтобы SQL модуля читался и правился в одном месте.
+# На скорость это не влияет: asyncpg и так кэширует подготовленные statement'ы на каждом
+# соединении по тексту запроса (statement_cache_size), а строковый литерал в теле функции —
+# такая же константа code-объекта. Явные PreparedStatement из init= пула не подходят —
+# asyncpg инвалидирует их при возврате соединения в пул.
+
+# Если INSERT сработал — строка из ins (у нового реферала списки пусты); иначе — существующая из referrals_full.
+# Оба SELECT видят один снимок, поэтому только что вставленная строка не попадёт во вторую ветку.
+_SQL_REF_GET_OR_CREATE = f"""
+    WITH ins AS (
+        INSERT INTO referrals (user_id)
+        VALUES ($1)
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING user_id, parent1, parent2, parent3, earned_rub, volume_rub, username, first_name
+    )
+    SELECT user_id::text, parent1::text, parent2::text, parent3::text,
+           '{{}}'::text[] AS referrals_l1, '{{}}'::text[] AS referrals_l2, '{{}}'::text[] AS referrals_l3,
+           earned_rub, volume_rub, username, first_name
+    FROM ins
+    UNION ALL
+    SELECT {_REF_COLUMNS}
+    FROM referrals_full WHERE user_id = $1
+    LIMIT 1
+"""
+
+_SQL_REF_ITER_ALL = f"SELECT {_REF_COLUMNS} FROM referrals_full"
+
+_SQL_REF_UPSERT = """
+    INSERT INTO referrals (user_id, parent1, parent2, parent3, earned_rub, volume_rub, username, first_name)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+    ON CONFLICT (user_id) DO UPDATE SET
+        parent1 = EXCLUDED.parent1,
+        parent2 = EXCLUDED.parent2,
+        parent3 = EXCLUDED.parent3,
+        earned_rub = EXCLUDED.earned_rub,
+        volume_rub = EXCLUDED.volume_rub,
+        username = EXCLUDED.username,
+        first_name = EXCLUDED.first_name,
+        updated_at = NOW()
+"""
+
+# Параллельные массивы (parent_id[], child_id[], level[]) — любое число рёбер одним запросом
+_SQL_REF_EDGES_ADD = """
+    INSERT INTO referrals_edges (parent_id, child_id, level)
+    SELECT e.parent_id, e.child_id, e.level
+    FROM unnest($1::bigint[], $2::bigint[], $3::smallint[]) AS e(parent_id, child_id, level)
+    ON CONFLICT DO NOTHING
+"""
+
+# Только цепочка спонсоров: базовая таблица, без агрегации рёбер в referrals_full
+_SQL_REF_GET_PARENTS = """
+    SELECT parent1::text AS parent1, parent2::text AS parent2, parent3::text AS parent3
+    FROM referrals WHERE user_id = $1
+"""
+
+_SQL_REF_FIND_PARENTS = """
+    SELECT parent_id::text AS parent_id FROM referrals_edges WHERE child_id = $1 AND level = $2
+"""
+
+_SQL_REF_ADD_EARNED = """
+    UPDATE referrals SET
+        volume_rub = volume_rub + $2,
+        earned_rub = earned_rub + $3,
+        updated_at = NOW()
+    WHERE user_id = $1
+"""
+
+_SQL_REF_SET_EARNED = """
+    UPDATE referrals SET earned_rub = $2, updated_at = NOW() WHERE user_id = $1
+"""
+
+_SQL_USER_UPSERT = """
+    INSERT INTO users (id, username, first_name)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (id) DO UPDATE SET
+        username = COALESCE(NULLIF($2,''), users.username),
+        first_name = COALESCE(NULLIF($3,''), users.first_name)
+"""
+
+_SQL_USER_FIND_BY_USERNAME = """
+    SELECT id::text AS id FROM users WHERE LOWER(username) = LOWER($1) LIMIT 1
+"""
+
+_SQL_PURCHASE_ADD = """
+    INSERT INTO purchases (user_id, amount_rub, stars_amount, type, product_name, order_id)
+    VALUES ($1, $2, $3, $4, $5, $6)
+"""
+
+# Группировка покупок по пользователю делается в PostgreSQL: одна строка на пользователя.
+# В рейтинг идут ТОЛЬКО покупки звёзд (type = 'stars'), пополнения баланса и прочие типы игнорируются.
+# FULL JOIN — чтобы не терять покупки пользователей без записи в users.
+_SQL_USERS_WITH_PURCHASES = """
+    WITH p AS (
+        SELECT
+            user_id,
+            MAX(created_at) AS last_purchase,
+            json_agg(json_build_object(
+                'amount_rub', amount_rub,
+                'stars_amount', stars_amount_eff,
+                'type', type,
+                'product_name', product_name,
+                'created_at', to_char(created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS')
+            ) ORDER BY created_at DESC) AS purchases
+        FROM purchases
+        WHERE LOWER(type) = 'stars'
+        GROUP BY user_id
+    )
+    SELECT
+        COALESCE(u.id, p.user_id)::text AS user_id,
+        u.username, u.first_name,
+        to_char(u.created_at AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS') AS registration_date,
+        -- Самая свежая покупка, иначе — дата регистрации
+        to_char(COALESCE(p.last_purchase, u.created_at) AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS') AS last_activity,
+        p.purchases
+    FROM users u
+    FULL OUTER JOIN p ON p.user_id = u.id
+"""
+
+_SQL_RATING_GET_ALL = "SELECT user_id::text AS user_id, show_in_rating FROM rating_prefs"
+
+_SQL_RATING_SET = """
+    INSERT INTO rating_prefs (user_id, show_in_rating)
+    VALUES ($1, $2)
+    ON CONFLICT (user_id) DO UPDATE SET show_in_rating = $2, updated_at = NOW()
+"""
+
+_SQL_RATES_GET = "SELECT key, value FROM app_rates"
+
+_SQL_RATES_SET = """
+    INSERT INTO app_rates (key, value) VALUES ($1, $2)
+    ON CONFLICT (key) DO UPDATE SET value = $2, updated_at = NOW()
+"""
+
+_SQL_BALANCE_GET = "SELECT balance_rub, balance_usdt FROM user_balances WHERE user_id = $1"
+
+# Зачисление (обе дельты >= 0): upsert, не может не пройти
+_SQL_BALANCE_CREDIT = """
+    INSERT INTO user_balances (user_id, balance_rub, balance_usdt)
+    VALUES ($1, $2, $3)
+    ON CONFLICT (user_id) DO UPDATE SET
+        balance_rub = user_balances.balance_rub + EXCLUDED.balance_rub,
+        balance_usdt = user_balances.balance_usdt + EXCLUDED.balance_usdt,
+        updated_at = NOW()
+    RETURNING balance_rub, balance_usdt
+"""
+
+# Списание (хотя бы одна дельта < 0): только существующая запись и только без ухода в минус
+_SQL_BALANCE_APPLY = """
+    UPDATE user_balances
+    SET balance_rub = balance_rub + $2, balance_usdt = balance_usdt + $3, updated_at = NOW()
+    WHERE user_id = $1 AND balance_rub + $2 >= 0 AND balance_usdt + $3 >= 0
+    RETURNING balance_rub, balance_usdt
+"""
+
+# Сброс кэша курсов в других процессах (см. _start_listener)
+_SQL_NOTIFY_RATES_CHANGED = "NOTIFY rates_changed"
+
+
+# --- Referrals ---
+
+async def ref_get_or_create(user_id: int | str) -> dict:
+    """Получить или создать запись реферала (один запрос)."""
     async with _pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT * FROM referrals WHERE user_id = $1", user_id
-        )
-        if row:
-            return _row_to_ref(row)
-        await conn.execute("""
-            INSERT INTO referrals (user_id, referrals_l1, referrals_l2, referrals_l3)
-            VALUES ($1, '[]', '[]', '[]')
-            ON CONFLICT (user_id) DO NOTHING
-        """, user_id)
-        row = await conn.fetchrow("SELECT * FROM referrals WHERE user_id = $1", user_id)
-        return _row_to_ref(row) if row else {
-            "parent1": None, "parent2": None, "parent3": None,
-            "referrals_l1": [], "referrals_l2": [], "referrals_l3": [],
-            "earned_rub": 0.0, "volume_rub": 0.0,
-        }
+        row = await conn.fetchrow(_SQL_REF_GET_OR_CREATE, _uid(user_id))
+    # Пусто только при гонке с параллельной вставкой, ещё не видимой нашему снимку
+    return _row_to_ref(row) if row else {
+        "parent1": None, "parent2": None, "parent3": None,
+        "referrals_l1": [], "referrals_l2": [], "referrals_l3": [],
+        "earned_rub": 0.0, "volume_rub": 0.0,
+        "username": "", "first_name": "",
+    }
 
 
 def _row_to_ref(row) -> dict:
-    r = dict(row)
-    for k in ("referrals_l1", "referrals_l2", "referrals_l3"):
-        v = r.get(k)
-        if isinstance(v, list):
-            r[k] = v
-        elif isinstance(v, str):
-            try:
-                r[k] = json.loads(v) if v else []
-            except Exception:
-                r[k] = []
-        else:
-            r[k] = [] if v is None else list(v) if hasattr(v, "__iter__") and not isinstance(v, str) else []
+    # _REF_COLUMNS всегда отдаёт списки как text[] (пустой — '{}'), так что ветвление по типам не нужно
     return {
-        "parent1": r.get("parent1"),
-        "parent2": r.get("parent2"),
-        "parent3": r.get("parent3"),
-        "referrals_l1": r.get("referrals_l1") or [],
-        "referrals_l2": r.get("referrals_l2") or [],
-        "referrals_l3": r.get("referrals_l3") or [],
-        "earned_rub": float(r.get("earned_rub") or 0),
-        "volume_rub": float(r.get("volume_rub") or 0),
-        "username": r.get("username") or "",
-        "first_name": r.get("first_name") or "",
+        "parent1": row["parent1"],
+        "parent2": row["parent2"],
+        "parent3": row["parent3"],
+        "referrals_l1": row["referrals_l1"],
+        "referrals_l2": row["referrals_l2"],
+        "referrals_l3": row["referrals_l3"],
+        "earned_rub": float(row["earned_rub"] or 0),
+        "volume_rub": float(row["volume_rub"] or 0),
+        "username": row["username"] or "",
+        "first_name": row["first_name"] or "",
     }
 
 
-async def ref_save(user_id: str, data: dict):
-    """Сохранить запись реферала."""
-    if not _db_enabled:
+def _ref_valid_items(items) -> list:
+    """
+    (user_id, data), ... без записей с не-числовым user_id или parent1..3: _uid() на них бросает
+    ValueError и уронил бы всю пачку. Пропущенные записи логируются.
+    """
+    valid = []
+    for user_id, data in items:
+        ids = [user_id] + [data.get(f"parent{i}") for i in (1, 2, 3) if data.get(f"parent{i}") not in (None, "")]
+        if all(is_user_id(x) for x in ids):
+            valid.append((user_id, data))
+        else:
+            logger.warning("ref_save: запись с не-числовым ID пропущена (user_id=%r)", user_id)
+    return valid
+
+
+def _ref_upsert_args(user_id: int | str, data: dict) -> tuple:
+    return (
+        _uid(user_id),
+        _uid(data.get("parent1")), _uid(data.get("parent2")), _uid(data.get("parent3")),
+        float(data.get("earned_rub") or 0),
+        float(data.get("volume_rub") or 0),
+        data.get("username") or "",
+        data.get("first_name") or "",
+    )
+
+
+def _ref_edges_args(items) -> tuple:
+    """(user_id, data), ... -> параллельные массивы для _SQL_REF_EDGES_ADD."""
+    parents, children, levels = [], [], []
+    for user_id, data in items:
+        for level in (1, 2, 3):
+            for child in data.get(f"referrals_l{level}") or []:
+                if not is_user_id(child):
+                    continue
+                parents.append(_uid(user_id))
+                children.append(_uid(child))
+                levels.append(level)
+    return parents, children, levels
+
+
+async def ref_save(user_id: int | str, data: dict):
+    """Сохранить запись реферала. Списки referrals_l* дописываются в referrals_edges."""
+    items = _ref_valid_items([(user_id, data)])
+    if not items:
         return
     async with _pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO referrals (user_id, parent1, parent2, parent3, referrals_l1, referrals_l2, referrals_l3, earned_rub, volume_rub, username, first_name)
-            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
-            ON CONFLICT (user_id) DO UPDATE SET
-                parent1 = EXCLUDED.parent1,
-                parent2 = EXCLUDED.parent2,
-                parent3 = EXCLUDED.parent3,
-                referrals_l1 = EXCLUDED.referrals_l1,
-                referrals_l2 = EXCLUDED.referrals_l2,
-                referrals_l3 = EXCLUDED.referrals_l3,
-                earned_rub = EXCLUDED.earned_rub,
-                volume_rub = EXCLUDED.volume_rub,
-                username = EXCLUDED.username,
-                first_name = EXCLUDED.first_name,
-                updated_at = NOW()
-        """, user_id,
-            data.get("parent1"), data.get("parent2"), data.get("parent3"),
-            json.dumps(data.get("referrals_l1") or []),
-            json.dumps(data.get("referrals_l2") or []),
-            json.dumps(data.get("referrals_l3") or []),
-            float(data.get("earned_rub") or 0),
-            float(data.get("volume_rub") or 0),
-            data.get("username") or "",
-            data.get("first_name") or "",
-        )
+        async with conn.transaction():
+            await conn.execute(_SQL_REF_UPSERT, *_ref_upsert_args(user_id, data))
+            await conn.execute(_SQL_REF_EDGES_ADD, *_ref_edges_args(items))
+
+
+async def ref_save_many(refs: dict):
+    """Сохранить пачку реферальных записей (user_id -> dict) в одной транзакции: executemany + один INSERT рёбер."""
+    items = _ref_valid_items(refs.items())
+    if not items:
+        return
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.executemany(
+                _SQL_REF_UPSERT,
+                [_ref_upsert_args(uid, data) for uid, data in items],
+            )
+            await conn.execute(_SQL_REF_EDGES_ADD, *_ref_edges_args(items))
+
+
+async def ref_iter_all(prefetch: int = 1000) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Потоково отдать все реферальные записи (user_id, dict) через серверный курсор.
+    В памяти держится не больше prefetch строк, а не вся таблица.
+    """
+    async with _pool.acquire() as conn:
+        async with conn.transaction():
+            async for row in conn.cursor(_SQL_REF_ITER_ALL, prefetch=prefetch):
+                yield row["user_id"], _row_to_ref(row)
 
 
 async def ref_load_all() -> dict:
-    """Загрузить все реферальные данные (user_id -> dict)."""
-    if not _db_enabled:
-        return {}
+    """Загрузить все реферальные данные (user_id -> dict). Обёртка над ref_iter_all для старых вызовов."""
+    return {user_id: ref async for user_id, ref in ref_iter_all()}
+
+
+async def ref_get_parents(user_id: int | str) -> Optional[dict]:
+    """Спонсоры пользователя {parent1, parent2, parent3} без загрузки списков рефералов; None, если записи нет."""
     async with _pool.acquire() as conn:
-        rows = await conn.fetch("SELECT * FROM referrals")
-    return {r["user_id"]: _row_to_ref(r) for r in rows}
+        row = await conn.fetchrow(_SQL_REF_GET_PARENTS, _uid(user_id))
+    if not row:
+        return None
+    return {"parent1": row["parent1"], "parent2": row["parent2"], "parent3": row["parent3"]}
 
 
-async def ref_add_earned(user_id: str, volume_delta: float, earned_delta: float):
-    """Добавить объём и заработок родителю."""
-    if not _db_enabled:
-        return
+async def ref_find_parent_by_child(child_id: int | str, level: int) -> list[str]:
+    """Найти user_id, у которых child_id есть в referrals_l{level} (через idx_ref_edges_child)."""
+    if level not in (1, 2, 3):
+        raise ValueError(f"level must be 1, 2 or 3, got {level!r}")
     async with _pool.acquire() as conn:
-        await conn.execute("""
-            UPDATE referrals SET
-                volume_rub = volume_rub + $2,
-                earned_rub = earned_rub + $3,
-                updated_at = NOW()
-            WHERE user_id = $1
-        """, user_id, volume_delta, earned_delta)
+        rows = await conn.fetch(_SQL_REF_FIND_PARENTS, _uid(child_id), level)
+    return [r["parent_id"] for r in rows]
 
 
-async def ref_set_earned(user_id: str, earned_rub: float):
+async def ref_add_earned(user_id: int | str, volume_delta: float, earned_delta: float, *, conn=None):
+    """Добавить объём и заработок родителю."""
+    async with _acquire(conn) as conn:
+        await conn.execute(_SQL_REF_ADD_EARNED, _uid(user_id), volume_delta, earned_delta)
+
+
+async def ref_set_earned(user_id: int | str, earned_rub: float, *, conn=None):
     """Установить earned_rub (при выводе)."""
-    if not _db_enabled:
-        return
-    async with _pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE referrals SET earned_rub = $2, updated_at = NOW() WHERE user_id = $1",
-            user_id, earned_rub
-        )
+    async with _acquire(conn) as conn:
+        await conn.execute(_SQL_REF_SET_EARNED, _uid(user_id), earned_rub)
 
 
 # --- Users & Purchases ---
 
-async def user_upsert(user_id: str, username: str = "", first_name: str = ""):
+async def user_upsert(user_id: int | str, username: str = "", first_name: str = "", *, conn=None):
     """Создать/обновить пользователя."""
-    if not _db_enabled:
-        return
-    async with _pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users (id, username, first_name)
-            VALUES ($1, $2, $3)
-            ON CONFLICT (id) DO UPDATE SET
-                username = COALESCE(NULLIF($2,''), users.username),
-                first_name = COALESCE(NULLIF($3,''), users.first_name)
-        """, user_id, username or "", first_name or "")
+    async with _acquire(conn) as conn:
+        await conn.execute(_SQL_USER_UPSERT, _uid(user_id), username or "", first_name or "")
 
 
-async def purchase_add(user_id: str, amount_rub: float, stars_amount: int, ptype: str, product_name: str, order_id: str | None = None):
+async def purchase_add(user_id: int | str, amount_rub: float, stars_amount: int, ptype: str, product_name: str, order_id: str | None = None, *, conn=None):
     """Добавить покупку. order_id — наш внешний ID (#ABC123), может быть None."""
-    if not _db_enabled:
-        return
+    async with _acquire(conn) as conn:
+        await conn.execute(_SQL_PURCHASE_ADD, _uid(user_id), amount_rub, stars_amount or 0, ptype or "stars", product_name or "", order_id or None)
+
+
+async def purchase_add_many(rows: Iterable[tuple], *, durable: bool = True) -> int:
+    """
+    Пакетная вставка покупок (бэкфилл, миграции, повтор аналитики) одним бинарным COPY.
+    rows: (user_id, amount_rub, stars_amount, type, product_name, order_id).
+    durable=False отключает synchronous_commit для этой транзакции — для данных, которые можно перезалить.
+    Возвращает число вставленных строк.
+    """
+    records = [
+        (_uid(user_id), amount_rub, stars_amount or 0, ptype or "stars", product_name or "", order_id or None)
+        for user_id, amount_rub, stars_amount, ptype, product_name, order_id in rows
+    ]
+    if not records:
+        return 0
     async with _pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO purchases (user_id, amount_rub, stars_amount, type, product_name, order_id)
-            VALUES ($1, $2, $3, $4, $5, $6)
-        """, user_id, amount_rub, stars_amount or int(amount_rub / 0.65), ptype or "stars", product_name or "", order_id or None)
+        async with conn.transaction():
+            if not durable:
+                await conn.execute("SET LOCAL synchronous_commit = off")
+            await conn.copy_records_to_table(
+                "purchases",
+                records=records,
+                columns=("user_id", "amount_rub", "stars_amount", "type", "product_name", "order_id"),
+            )
+    logger.info("purchase_add_many: inserted %d purchases", len(records))
+    return len(records)
 
 
 async def get_users_with_purchases() -> dict:
     """Все пользователи с покупками (для рейтинга и статистики). user_id -> {username, first_name, registration_date, last_activity, purchases: [...]}"""
-    if not _db_enabled:
-        return {}
     async with _pool.acquire() as conn:
-        # Сначала получаем всех пользователей с датами регистрации
-        user_rows = await conn.fetch("SELECT id, username, first_name, created_at FROM users")
-        users = {}
-        for ur in user_rows:
-            uid = ur["id"]
-            users[uid] = {
-                "username": ur["username"] or "",
-                "first_name": ur["first_name"] or "",
-                "registration_date": ur["created_at"].strftime("%Y-%m-%d %H:%M:%S") if ur["created_at"] else "",
-                "created_at": ur["created_at"].strftime("%Y-%m-%d %H:%M:%S") if ur["created_at"] else "",
-                "last_activity": "",  # Будет обновлено из последней покупки
-                "purchases": []
-            }
-        
-        # Затем получаем покупки. В рейтинг идут ТОЛЬКО покупки звёзд (type = 'stars'),
-        # пополнения баланса и прочие типы здесь игнорируются.
-        purchase_rows = await conn.fetch("""
-            SELECT user_id, amount_rub, stars_amount, type, product_name, created_at
-            FROM purchases
-            WHERE LOWER(type) = 'stars'
-            ORDER BY created_at DESC
-        """)
-        
-        for pr in purchase_rows:
-            uid = pr["user_id"]
-            if uid not in users:
-                users[uid] = {"username": "", "first_name": "", "registration_date": "", "created_at": "", "last_activity": "", "purchases": []}
-            purchase_date = pr["created_at"].strftime("%Y-%m-%d %H:%M:%S") if pr["created_at"] else ""
-            users[uid]["purchases"].append({
-                "amount": float(pr["amount_rub"]),
-                "amount_rub": float(pr["amount_rub"]),
-                "stars_amount": pr["stars_amount"] or 0,
-                "type": pr["type"] or "stars",
-                "productName": pr["product_name"] or "",
-                "date": purchase_date,
-                "created_at": purchase_date,
-            })
-            # Обновляем last_activity самой свежей покупкой
-            if purchase_date and (not users[uid]["last_activity"] or purchase_date > users[uid]["last_activity"]):
-                users[uid]["last_activity"] = purchase_date
-        
-        # Если у пользователя нет покупок, но есть регистрация — last_activity = registration_date
-        for uid, u in users.items():
-            if not u["last_activity"] and u["registration_date"]:
-                u["last_activity"] = u["registration_date"]
-    
+        rows = await conn.fetch(_SQL_USERS_WITH_PURCHASES)
+
+    users = {}
+    for row in rows:
+        created = row["registration_date"] or ""
+        purchases = row["purchases"] or []
+        users[row["user_id"]] = {
+            "username": row["username"] or "",
+            "first_name": row["first_name"] or "",
+            "registration_date": created,
+            "created_at": created,
+            "last_activity": row["last_activity"] or "",
+            "purchases": [
+                {
+                    "amount": float(p["amount_rub"]),
+                    "amount_rub": float(p["amount_rub"]),
+                    "stars_amount": p["stars_amount"] or 0,
+                    "type": p["type"] or "stars",
+                    "productName": p["product_name"] or "",
+                    "date": p["created_at"] or "",
+                    "created_at": p["created_at"] or "",
+                }
+                for p in purchases
+            ],
+        }
     return users
 
 
@@ -328,38 +688,45 @@ async def get_users_with_purchases() -> dict:
 
 async def rating_get_all() -> dict:
     """user_id -> {show_in_rating: bool}"""
-    if not _db_enabled:
-        return {}
     async with _pool.acquire() as conn:
-        rows = await conn.fetch("SELECT user_id, show_in_rating FROM rating_prefs")
+        rows = await conn.fetch(_SQL_RATING_GET_ALL)
     return {r["user_id"]: {"show_in_rating": r["show_in_rating"]} for r in rows}
 
 
-async def rating_set(user_id: str, show: bool):
+async def rating_set(user_id: int | str, show: bool):
     """Установить видимость в рейтинге."""
-    if not _db_enabled:
-        return
     async with _pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO rating_prefs (user_id, show_in_rating)
-            VALUES ($1, $2)
-            ON CONFLICT (user_id) DO UPDATE SET show_in_rating = $2, updated_at = NOW()
-        """, user_id, show)
+        await conn.execute(_SQL_RATING_SET, _uid(user_id), show)
 
 
 # --- App rates (курсы звёзд, Steam, Premium для FreeKassa и др.) ---
 
+def _rates_cache_invalidate():
+    """Сбросить кэш курсов — следующий rates_get() перечитает БД."""
+    global _rates_cache, _rates_cache_gen
+    _rates_cache = None
+    _rates_cache_gen += 1
+
+
 async def rates_get() -> dict:
-    """Получить все курсы из БД. key -> value (float)."""
-    if not _db_enabled:
-        logger.debug("rates_get: DB not enabled, returning empty dict")
-        return {}
+    """
+    Получить все курсы из БД. key -> value (float).
+    Кэш сбрасывается по NOTIFY rates_changed; _RATES_TTL — страховка на случай обрыва LISTEN-соединения.
+    """
+    global _rates_cache, _rates_cache_ts
+    if _rates_cache is not None and time.monotonic() - _rates_cache_ts < _RATES_TTL:
+        return _rates_cache.copy()
+    gen = _rates_cache_gen
     try:
         async with _pool.acquire() as conn:
-            rows = await conn.fetch("SELECT key, value FROM app_rates")
+            rows = await conn.fetch(_SQL_RATES_GET)
         result = {r["key"]: float(r["value"]) for r in rows if r["value"] is not None}
         logger.debug(f"rates_get: Retrieved {len(result)} rates from DB: {list(result.keys())}")
-        return result
+        # Если за время запроса пришёл NOTIFY rates_changed, результат мог устареть — не кэшируем
+        if gen == _rates_cache_gen:
+            _rates_cache = result
+            _rates_cache_ts = time.monotonic()
+        return result.copy()
     except Exception as e:
         logger.error(f"rates_get error: {e}", exc_info=True)
         return {}
@@ -367,16 +734,12 @@ async def rates_get() -> dict:
 
 async def rates_set(key: str, value: float):
     """Установить курс. key: star_price_rub, star_buy_rate_rub, steam_rate_rub, premium_3, premium_6, premium_12."""
-    if not _db_enabled:
-        logger.warning(f"rates_set: DB not enabled, cannot save {key}={value}")
-        return
     try:
         async with _pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO app_rates (key, value) VALUES ($1, $2)
-                ON CONFLICT (key) DO UPDATE SET value = $2, updated_at = NOW()
-            """, key, value)
+            await conn.execute(_SQL_RATES_SET, key, value)
+            await conn.execute(_SQL_NOTIFY_RATES_CHANGED)
             logger.info(f"rates_set: Saved {key}={value} to PostgreSQL")
+        _rates_cache_invalidate()
     except Exception as e:
         logger.error(f"rates_set error for {key}={value}: {e}", exc_info=True)
         raise
@@ -384,15 +747,10 @@ async def rates_set(key: str, value: float):
 
 # --- User balances (защищённое хранение: только сервер меняет) ---
 
-async def balance_get(user_id: str) -> dict:
+async def balance_get(user_id: int | str, *, conn=None) -> dict:
     """Получить баланс пользователя. Возвращает { balance_rub, balance_usdt }."""
-    if not _db_enabled:
-        return {"balance_rub": 0.0, "balance_usdt": 0.0}
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT balance_rub, balance_usdt FROM user_balances WHERE user_id = $1",
-            user_id,
-        )
+    async with _acquire(conn) as conn:
+        row = await conn.fetchrow(_SQL_BALANCE_GET, _uid(user_id))
     if not row:
         return {"balance_rub": 0.0, "balance_usdt": 0.0}
     return {
@@ -406,95 +764,118 @@ async def user_find_by_username(username: str) -> Optional[str]:
     Найти user_id по Telegram username (без @). Возвращает ID или None.
     Используется в админке для ручной правки баланса.
     """
-    if not _db_enabled:
-        return None
     if not username:
         return None
     uname = username.strip().lstrip("@")
     if not uname:
         return None
     async with _pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT id FROM users WHERE LOWER(username) = LOWER($1) LIMIT 1",
-            uname.lower(),
-        )
+        row = await conn.fetchrow(_SQL_USER_FIND_BY_USERNAME, uname.lower())
     return row["id"] if row and row.get("id") else None
 
 
-async def balance_add_rub(user_id: str, amount: float) -> bool:
-    """Зачислить рубли на баланс (только с сервера, например после вебхука оплаты)."""
-    if not _db_enabled or amount <= 0:
-        return False
-    amount = round(amount, 2)
-    async with _pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO user_balances (user_id, balance_rub, balance_usdt)
-            VALUES ($1, $2, 0)
-            ON CONFLICT (user_id) DO UPDATE SET
-                balance_rub = user_balances.balance_rub + EXCLUDED.balance_rub,
-                updated_at = NOW()
-        """, user_id, amount)
-    logger.info("balance_add_rub: user_id=%s amount=%.2f", user_id, amount)
-    return True
-
-
-async def balance_add_usdt(user_id: str, amount: float) -> bool:
-    """Зачислить USDT на баланс (только с сервера)."""
-    if not _db_enabled or amount <= 0:
-        return False
-    amount = round(amount, 6)
-    async with _pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO user_balances (user_id, balance_rub, balance_usdt)
-            VALUES ($1, 0, $2)
-            ON CONFLICT (user_id) DO UPDATE SET
-                balance_usdt = user_balances.balance_usdt + EXCLUDED.balance_usdt,
-                updated_at = NOW()
-        """, user_id, amount)
-    logger.info("balance_add_usdt: user_id=%s amount=%.6f", user_id, amount)
-    return True
-
-
-async def balance_deduct_rub(user_id: str, amount: float) -> Optional[dict]:
+async def balance_apply_delta(
+    user_id: int | str, rub_delta: float = 0.0, usdt_delta: float = 0.0, *, conn=None
+) -> Optional[dict]:
     """
-    Списать рубли с баланса атомарно. Возвращает новый баланс { balance_rub, balance_usdt } или None при недостатке средств.
+    Атомарно изменить оба баланса одним запросом (только с сервера).
+    Возвращает новый баланс { balance_rub, balance_usdt } или None, если списание увело бы баланс в минус
+    (или списывать не с чего — записи нет).
     """
-    if not _db_enabled or amount <= 0:
+    rub_delta = round(rub_delta, 2)
+    usdt_delta = round(usdt_delta, 6)
+    sql = _SQL_BALANCE_CREDIT if rub_delta >= 0 and usdt_delta >= 0 else _SQL_BALANCE_APPLY
+    async with _acquire(conn) as conn:
+        row = await conn.fetchrow(sql, _uid(user_id), rub_delta, usdt_delta)
+    if not row:
+        # Недостаточно средств или записи нет
         return None
-    amount = round(amount, 2)
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            UPDATE user_balances
-            SET balance_rub = balance_rub - $2, updated_at = NOW()
-            WHERE user_id = $1 AND balance_rub >= $2
-            RETURNING balance_rub, balance_usdt
-        """, user_id, amount)
-        if not row:
-            # Недостаточно средств или записи нет — проверяем текущий баланс
-            row = await conn.fetchrow(
-                "SELECT balance_rub, balance_usdt FROM user_balances WHERE user_id = $1",
-                user_id,
-            )
-            return None
-    logger.info("balance_deduct_rub: user_id=%s amount=%.2f new_rub=%.2f", user_id, amount, float(row["balance_rub"]))
-    return {"balance_rub": float(row["balance_rub"]), "balance_usdt": float(row["balance_usdt"] or 0)}
+    logger.info(
+        "balance_apply_delta: user_id=%s rub=%+.2f usdt=%+.6f new_rub=%.2f new_usdt=%.6f",
+        user_id, rub_delta, usdt_delta, float(row["balance_rub"]), float(row["balance_usdt"]),
+    )
+    return {"balance_rub": float(row["balance_rub"]), "balance_usdt": float(row["balance_usdt"])}
 
 
-async def balance_deduct_usdt(user_id: str, amount: float) -> Optional[dict]:
-    """
-    Списать USDT с баланса атомарно. Возвращает новый баланс или None при недостатке средств.
-    """
-    if not _db_enabled or amount <= 0:
+async def balance_add_rub(user_id: int | str, amount: float, *, conn=None) -> bool:
+    """Зачислить рубли на баланс. Обёртка над balance_apply_delta."""
+    if amount <= 0:
+        return False
+    return await balance_apply_delta(user_id, rub_delta=amount, conn=conn) is not None
+
+
+async def balance_add_usdt(user_id: int | str, amount: float, *, conn=None) -> bool:
+    """Зачислить USDT на баланс. Обёртка над balance_apply_delta."""
+    if amount <= 0:
+        return False
+    return await balance_apply_delta(user_id, usdt_delta=amount, conn=conn) is not None
+
+
+async def balance_deduct_rub(user_id: int | str, amount: float, *, conn=None) -> Optional[dict]:
+    """Списать рубли атомарно. Обёртка над balance_apply_delta: новый баланс или None при недостатке средств."""
+    if amount <= 0:
         return None
-    amount = round(amount, 6)
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow("""
-            UPDATE user_balances
-            SET balance_usdt = balance_usdt - $2, updated_at = NOW()
-            WHERE user_id = $1 AND balance_usdt >= $2
-            RETURNING balance_rub, balance_usdt
-        """, user_id, amount)
-        if not row:
-            return None
-    logger.info("balance_deduct_usdt: user_id=%s amount=%.6f new_usdt=%.6f", user_id, amount, float(row["balance_usdt"]))
-    return {"balance_rub": float(row["balance_rub"] or 0), "balance_usdt": float(row["balance_usdt"])}
+    return await balance_apply_delta(user_id, rub_delta=-amount, conn=conn)
+
+
+async def balance_deduct_usdt(user_id: int | str, amount: float, *, conn=None) -> Optional[dict]:
+    """Списать USDT атомарно. Обёртка над balance_apply_delta: новый баланс или None при недостатке средств."""
+    if amount <= 0:
+        return None
+    return await balance_apply_delta(user_id, usdt_delta=-amount, conn=conn)
+
+
+# --- Заглушки на время, пока PostgreSQL отключён ---
+# Вместо проверки `if not _db_enabled` в каждой функции: до init_pool() (и после close_pool())
+# публичные имена модуля указывают на заглушки, а init_pool() подменяет их реальными функциями.
+
+def _disabled(default_factory=lambda: None):
+    async def _disabled_call(*args, **kwargs):
+        return default_factory()
+    return _disabled_call
+
+
+async def _ref_iter_all_disabled(*args, **kwargs):
+    return
+    yield
+
+
+async def _rates_get_disabled(*args, **kwargs):
+    logger.debug("rates_get: DB not enabled, returning empty dict")
+    return {}
+
+
+async def _rates_set_disabled(key, value, *args, **kwargs):
+    logger.warning(f"rates_set: DB not enabled, cannot save {key}={value}")
+
+
+@asynccontextmanager
+async def _transaction_disabled():
+    # conn=None — вызовы внутри блока уходят в такие же заглушки
+    yield None
+
+
+_DISABLED_BACKEND = {
+    "transaction": _transaction_disabled,
+    "ref_get_or_create": _disabled(),
+    "ref_save": _disabled(),
+    "ref_save_many": _disabled(),
+    "ref_iter_all": _ref_iter_all_disabled,
+    "ref_get_parents": _disabled(),
+    "ref_find_parent_by_child": _disabled(list),
+    "ref_add_earned": _disabled(),
+    "ref_set_earned": _disabled(),
+    "user_upsert": _disabled(),
+    "purchase_add": _disabled(),
+    "purchase_add_many": _disabled(int),
+    "get_users_with_purchases": _disabled(dict),
+    "rating_get_all": _disabled(dict),
+    "rating_set": _disabled(),
+    "rates_get": _rates_get_disabled,
+    "rates_set": _rates_set_disabled,
+    "balance_get": _disabled(lambda: {"balance_rub": 0.0, "balance_usdt": 0.0}),
+    "user_find_by_username": _disabled(),
+    "balance_apply_delta": _disabled(),
+}
+_REAL_BACKEND = {name: globals()[name] for name in _DISABLED_BACKEND}
+globals().update(_DISABLED_BACKEND)